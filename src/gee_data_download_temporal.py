@@ -3,44 +3,49 @@ Sentinel-2 Monthly Data Downloader for GeoJSON Points & Polygons
 
 This script downloads Sentinel-2 Surface Reflectance (SR) values for points or polygons
 provided in a GeoJSON file. It creates monthly median composites between a given start
-and end date, normalizes the bands, and exports all sampled values into a single CSV file.
+and end date, normalizes the bands, and exports all sampled values into a single Parquet file.
 
 Features:
 - Supports Point and Polygon geometries in GeoJSON.
 - Handles files with missing labels (for inference).
 - Splits large polygons to avoid GEE memory errors.
 - Filters images based on maximum cloud cover.
-- Normalizes each band to 0-1 range using unitScale.
-- Exports a single CSV with all points/polygons and months.
+- Normalizes all bands to 0-1 range (divided by 3000 and clipped), stored as uint16 x 10000.
+- Exports a single Parquet file with all points/polygons and months.
 """
 
 import argparse
+import contextlib
+import functools
+import json
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import ee
 import os
 import numpy as np
 import geopandas as gpd
 import pandas as pd
-from shapely.geometry import box
-from dateutil.relativedelta import relativedelta
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+import shapely
 from dotenv import load_dotenv
+from google.cloud import storage
 from loguru import logger
-import geemap
 from tqdm import tqdm
 from shapely.geometry import Polygon, MultiPolygon
 
-def loading_data(path_data: Path) -> gpd.GeoDataFrame:
-    """Load a GeoJSON or shapefile into a GeoDataFrame."""
-    try:
-        data = gpd.read_file(path_data, driver="GeoJSON")
-    except Exception as e:
-        raise RuntimeError(f"⚠️ Failed to read {path_data}: {e}")
-    if data.empty:
-        raise ValueError(f"⚠️ The file {path_data} is empty or invalid.")
-    logger.success(f"✅ Loaded {len(data)} records from {path_data}")
-    logger.info(f"Columns: {list(data.columns)} | CRS: {data.crs}")
-    return data
+from io_utils import loading_data
 
+HIGH_VOLUME_URL = "https://earthengine-highvolume.googleapis.com"
+S2_BANDS = ['B1','B2','B3','B4','B5','B6','B7','B8','B8A','B11','B12','B9']
+# Normalized 0-1 bands are exported as uint16 integers: value = round(normalized * BAND_SCALE)
+BAND_SCALE = 10000
+# Rows per Parquet row group
+ROW_GROUP_SIZE = 100_000
 
 def split_polygon_grid(polygon, max_cells=4):
     """
@@ -51,112 +56,350 @@ def split_polygon_grid(polygon, max_cells=4):
     x_steps = np.linspace(minx, maxx, max_cells + 1)
     y_steps = np.linspace(miny, maxy, max_cells + 1)
 
-    small_polys = []
-    for i in range(max_cells):
-        for j in range(max_cells):
-            b = box(x_steps[i], y_steps[j], x_steps[i + 1], y_steps[j + 1])
-            inter = polygon.intersection(b)
-            if not inter.is_empty:
-                if inter.geom_type == "Polygon":
-                    small_polys.append(inter)
-                elif inter.geom_type == "MultiPolygon":
-                    small_polys.extend(list(inter.geoms))
-    return small_polys
+    # All grid cells at once, intersected in a single vectorized GEOS call
+    x0, y0 = np.meshgrid(x_steps[:-1], y_steps[:-1], indexing="ij")
+    x1, y1 = np.meshgrid(x_steps[1:], y_steps[1:], indexing="ij")
+    cells = shapely.box(x0, y0, x1, y1).ravel()
+    inter = shapely.intersection(polygon, cells)
+
+    parts = shapely.get_parts(inter[~shapely.is_empty(inter)])
+    return list(parts[shapely.get_type_id(parts) == shapely.GeometryType.POLYGON])
+
+
+# Geometries sent to Earth Engine for each supported input geometry type
+GEOMETRY_SPLITTERS = {
+    "Point": lambda geom: [geom],
+    "Polygon": lambda geom: split_polygon_grid(geom, max_cells=4),
+    "MultiPolygon": lambda geom: split_polygon_grid(geom, max_cells=4),
+}
+
+
+@functools.lru_cache(maxsize=1)
+def _init_ee(project: str) -> bool:
+    """Initialize Earth Engine on the high-volume endpoint, once per process."""
+    try:
+        ee.Initialize(project=project, opt_url=HIGH_VOLUME_URL)
+    except ee.EEException:
+        # No stored credentials yet: authenticate only when needed
+        ee.Authenticate()
+        ee.Initialize(project=project, opt_url=HIGH_VOLUME_URL)
+    return True
+
+
+def init_ee() -> bool:
+    """Initialize Earth Engine for the project set in the EE_PROJECT environment variable."""
+    return _init_ee(os.getenv("EE_PROJECT"))
+
+
+def split_geometries(gdf, label_col):
+    """
+    Return one row per geometry sent to Earth Engine, in EPSG:4326.
+    Large polygons are split, unsupported types dropped, and each part keeps its source row in `geometry_idx`.
+    """
+    geom_types = gdf.geometry.geom_type
+    supported = geom_types.isin(list(GEOMETRY_SPLITTERS))
+    for idx, geom_type in geom_types[~supported].items():
+        logger.warning(f"Geometry type {geom_type} not supported. Skipping geometry {idx}.")
+    gdf = gdf[supported]
+
+    # Iterate over plain arrays rather than pandas rows
+    types = geom_types[supported].to_numpy()
+    geoms = gdf.geometry.to_numpy()
+    parts = pd.DataFrame({
+        'geometry_idx': gdf.index,
+        'geometry': [GEOMETRY_SPLITTERS[t](geom) for t, geom in zip(types, geoms)],
+    })
+    if label_col in gdf.columns:
+        parts[label_col] = gdf[label_col].to_numpy()
+    parts = parts.explode('geometry', ignore_index=True).dropna(subset=['geometry'])
+
+    parts = gpd.GeoDataFrame(parts, geometry='geometry', crs=gdf.crs)
+    return parts.to_crs(4326) if parts.crs is not None else parts
+
+
+def _cast_bands(table):
+    """Cast the band columns of a sampled table to uint16."""
+    for band in S2_BANDS:
+        table = table.set_column(table.schema.get_field_index(band), band, table[band].cast(pa.uint16()))
+    return table
+
+
+def iter_fc_tables(fc):
+    """
+    Fetch the feature properties of an ee.FeatureCollection as pyarrow Tables, one per page.
+    Pages are requested with computeFeatures and rows go straight to Arrow, without a pandas detour.
+    """
+    params = {'expression': fc}
+    while True:
+        page = ee.data.computeFeatures(params)
+        table = pa.Table.from_pylist([feature['properties'] for feature in page.get('features', [])])
+        if table.num_rows:
+            yield _cast_bands(table)
+        if not page.get('nextPageToken'):
+            break
+        params = {'expression': fc, 'pageToken': page['nextPageToken']}
+
+
+def gdf_to_ee(gdf):
+    """Upload a GeoDataFrame in one GeoJSON payload, parsed in bulk by Earth Engine."""
+    return ee.FeatureCollection(json.loads(gdf.to_json(drop_id=True)))
+
+
+def monthly_samples(fc_all, properties, start_date, end_date, cloud_thresh):
+    """
+    Sample the monthly median composites of all geometries as a single FeatureCollection.
+    The month loop runs server-side, so every month is fetched through one request.
+    """
+    # Month windows are computed once client-side: [start, start + 1 month - 1 day], clamped to end_date
+    end = pd.to_datetime(end_date)
+    month_starts = pd.date_range(pd.to_datetime(start_date), end, freq=pd.DateOffset(months=1), inclusive='left')
+    month_ends = month_starts + pd.DateOffset(months=1) - pd.Timedelta(days=1)
+    month_ends = month_ends.where(month_ends <= end, end)
+    month_edges = [[ms.strftime('%Y-%m-%d'), me.strftime('%Y-%m-%d')] for ms, me in zip(month_starts, month_ends)]
+
+    def _sample_month(edges):
+        edges = ee.List(edges)
+        month_start = ee.Date(edges.get(0))
+        month_end = ee.Date(edges.get(1))
+
+        s2 = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
+              .filterBounds(fc_all)
+              .filterDate(month_start, month_end)
+              .filter(ee.Filter.lte('CLOUDY_PIXEL_PERCENTAGE', cloud_thresh))
+              .select(S2_BANDS)
+              )
+
+        # Scale all bands at once to 0-1 (reflectance / 3000, clipped), then quantize
+        # server-side so less data is transferred from GEE
+        s2_normalized = s2.median().divide(3000).clamp(0, 1).multiply(BAND_SCALE).round().toUint16()
+
+        month = month_start.format('YYYY-MM')
+        samples = (s2_normalized
+                   .sampleRegions(collection=fc_all, properties=properties, scale=10)
+                   .map(lambda f: f.set('month', month)))
+        # Empty months are resolved server-side instead of a size().getInfo() round trip
+        return ee.Algorithms.If(s2.size().gt(0), samples, ee.FeatureCollection([]))
+
+    return ee.FeatureCollection(ee.List(month_edges).map(_sample_month)).flatten()
+
+
+def _sample_batch(gdf_batch, properties, start_date, end_date, cloud_thresh):
+    """Sample all months of one batch of geometries (thread task) and return its pages."""
+    fc = gdf_to_ee(gdf_batch)
+    return list(iter_fc_tables(monthly_samples(fc, properties, start_date, end_date, cloud_thresh)))
+
+
+def iter_batch_tables(gdf_parts, properties, start_date, end_date, cloud_thresh, workers=16, batch_size=500):
+    """
+    Sample geometries in batches of `batch_size` on a pool of `workers` threads.
+    Requests are network-bound, so threads overlap them; tables are yielded in batch order
+    (geometry, then month) as soon as each batch and those before it are done.
+    At most 2 * workers batches are in flight, which bounds the results held in memory.
+    """
+    batches = [gdf_parts.iloc[i:i + batch_size] for i in range(0, len(gdf_parts), batch_size)]
+    sample = functools.partial(_sample_batch, properties=properties, start_date=start_date,
+                               end_date=end_date, cloud_thresh=cloud_thresh)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    in_flight = deque()
+    try:
+        with tqdm(total=len(batches), desc="Batches") as progress:
+            for batch in batches:
+                if len(in_flight) >= 2 * workers:
+                    yield from in_flight.popleft().result()
+                    progress.update()
+                in_flight.append(executor.submit(sample, batch))
+            while in_flight:
+                yield from in_flight.popleft().result()
+                progress.update()
+    finally:
+        # On error, drop the batches not started yet instead of waiting for them
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def start_gcs_export(fc, selectors, bucket, prefix):
+    """Start a GEE batch task exporting a FeatureCollection as CSV to gs://bucket/prefix.csv."""
+    task = ee.batch.Export.table.toCloudStorage(collection=fc, description=prefix, bucket=bucket,
+                                                fileNamePrefix=prefix, fileFormat='CSV', selectors=selectors)
+    task.start()
+    logger.info(f"Export task {task.id} started, writing gs://{bucket}/{prefix}.csv")
+    return task
+
+
+def wait_for_task(task, poll_interval=10, max_interval=300):
+    """Poll a GEE batch task with exponential backoff until it completes."""
+    delay = poll_interval
+    while True:
+        status = task.status()
+        if status['state'] == 'COMPLETED':
+            return
+        if status['state'] in ('FAILED', 'CANCELLED'):
+            raise RuntimeError(f"⚠️ Export task {task.id} {status['state']}: {status.get('error_message', '')}")
+        time.sleep(delay)
+        delay = min(delay * 2, max_interval)
+
+
+def iter_gcs_export_tables(gdf_parts, properties, start_date, end_date, cloud_thresh, bucket, prefix,
+                           batch_size=500):
+    """
+    Export geometries in batches of `batch_size` to CSV on Cloud Storage, one GEE task per batch,
+    and stream the files back in batch order. GEE writes the files on its side, in parallel,
+    so large outputs avoid client-side paging; each request stays within EE's payload limits.
+    """
+    selectors = properties + S2_BANDS + ['month']
+    tasks = []
+    try:
+        for n, i in enumerate(range(0, len(gdf_parts), batch_size)):
+            fc = gdf_to_ee(gdf_parts.iloc[i:i + batch_size])
+            samples = monthly_samples(fc, properties, start_date, end_date, cloud_thresh)
+            batch_prefix = f"{prefix}_{n:05d}"
+            tasks.append((start_gcs_export(samples, selectors, bucket, batch_prefix), batch_prefix))
+
+        for task, batch_prefix in tqdm(tasks, desc="Exports"):
+            wait_for_task(task)
+            yield from iter_gcs_csv_tables(bucket, f"{batch_prefix}.csv")
+    except BaseException:
+        # Do not leave the remaining exports running on a failed run
+        for task, _ in tasks:
+            if task.active():
+                task.cancel()
+        raise
+
+
+def iter_gcs_csv_tables(bucket, blob_name):
+    """Stream a CSV stored on Cloud Storage as pyarrow Tables, one per record batch."""
+    client = storage.Client(project=os.getenv("EE_PROJECT"))
+    with client.bucket(bucket).blob(blob_name).open('rb') as f:
+        for batch in pacsv.open_csv(f):
+            if batch.num_rows:
+                yield _cast_bands(pa.Table.from_batches([batch]))
+
+
+def write_band_metadata(path):
+    """Write the sidecar JSON describing how band values are quantized."""
+    metadata = {
+        "bands": S2_BANDS,
+        "dtype": "uint16",
+        "scale": BAND_SCALE,
+        "description": "normalized = value / scale, where normalized = clip(reflectance / 3000, 0, 1)",
+    }
+    with open(path, "w") as f:
+        json.dump(metadata, f, indent=2)
+
+
+def write_parquet(tables, output_file):
+    """
+    Stream pyarrow Tables into `output_file`, with its .bands.json metadata sidecar.
+    Both are written to temporary siblings and moved into place only once every table is written,
+    so a failed run leaves no partial output and keeps any previous one. Returns False if nothing was sampled.
+    """
+    sidecar = output_file.with_name(output_file.stem + '.bands.json')
+    tmp_output = output_file.with_name(output_file.name + '.tmp')
+    tmp_sidecar = sidecar.with_name(sidecar.name + '.tmp')
+
+    writer = None
+    try:
+        # Pages are small: buffer them so every row group holds ROW_GROUP_SIZE rows
+        pending = []
+        pending_rows = 0
+        for table in tables:
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_output, table.schema, compression='zstd')
+            pending.append(table.select(writer.schema.names).cast(writer.schema))
+            pending_rows += table.num_rows
+            if pending_rows >= ROW_GROUP_SIZE:
+                buffered = pa.concat_tables(pending)
+                full_rows = pending_rows - pending_rows % ROW_GROUP_SIZE
+                writer.write_table(buffered.slice(0, full_rows), row_group_size=ROW_GROUP_SIZE)
+                pending = [buffered.slice(full_rows)]
+                pending_rows -= full_rows
+
+        if writer is None:
+            return False
+        if pending_rows:
+            writer.write_table(pa.concat_tables(pending), row_group_size=ROW_GROUP_SIZE)
+        writer.close()
+
+        write_band_metadata(tmp_sidecar)
+        os.replace(tmp_output, output_file)
+        os.replace(tmp_sidecar, sidecar)
+        return True
+    except BaseException:
+        if writer is not None and writer.is_open:
+            with contextlib.suppress(Exception):
+                writer.close()
+        tmp_output.unlink(missing_ok=True)
+        tmp_sidecar.unlink(missing_ok=True)
+        raise
+
 
 def get_sentinel2_monthly(path_data, start_date, end_date, cloud_thresh=30,
-                          label_col="landcover", output_file="all_points_s2.csv"):
+                          label_col="landcover", output_file="all_points_s2.parquet",
+                          bbox=None, roi=None, export_backend="local", workers=16, batch_size=500):
     """
     Download Sentinel-2 monthly composites for GeoJSON Points & Polygons.
     Handles missing labels (inference) and large polygons.
+    Months are sampled server-side; geometries are sent in batches of `batch_size`,
+    requested in parallel on `workers` threads.
+    bbox (minx, miny, maxx, maxy, in the CRS of path_data) or roi (file whose geometries are used
+    as mask, reprojected to the CRS of path_data) restrict the features read; use one or the other.
+    export_backend="gcs" runs one GEE export per batch to the GCS_BUCKET bucket for large outputs
+    instead of paging the samples through the client ("local").
     """
     try:
-        gdf = loading_data(path_data)
+        init_ee()
+        mask = loading_data(roi) if roi is not None else None
+        gdf = loading_data(path_data, bbox=bbox, mask=mask)
 
         # Determine inference mode (no labels at all)
         if label_col not in gdf.columns or gdf[label_col].isnull().all():
             logger.info("⚠️ No labels found, download for inference only.")
             gdf_points = gdf.copy()
+            properties = ['geometry_idx']
         else:
             # Drop only rows without labels
             gdf_points = gdf.dropna(subset=[label_col])
+            properties = [label_col, 'geometry_idx']
 
         if gdf_points.empty:
             logger.warning("⚠️ No valid points/polygons to process. Exiting.")
             return
 
-        all_samples = []
-        start = pd.to_datetime(start_date)
-        end = pd.to_datetime(end_date)
-
-        for idx, row in tqdm(gdf_points.iterrows(), total=len(gdf_points), desc="Geometries"):
-
-            geom_type = row.geometry.geom_type
-            ee_geoms = []
-
-            if geom_type == "Point":
-                ee_geoms = [ee.Geometry.Point(row.geometry.coords[0])]
-            elif geom_type == "Polygon":
-                polys = split_polygon_grid(row.geometry, max_cells=4)
-                ee_geoms = [ee.Geometry.Polygon(list(p.exterior.coords)) for p in polys]
-            elif geom_type == "MultiPolygon":
-                polys = split_polygon_grid(row.geometry, max_cells=4)
-                ee_geoms = [ee.Geometry.MultiPolygon(list(p.exterior.coords)) for p in polys]
-            else:
-                logger.warning(f"Geometry type {geom_type} not supported. Skipping geometry {idx}.")
-                continue
-
-            properties = {label_col: row[label_col]} if label_col in row and not pd.isna(row[label_col]) else {}
-
-            for geom in ee_geoms:
-                fc_geom = ee.FeatureCollection([ee.Feature(geom, properties)])
-                current = start
-
-                while current < end:
-                    month_start = current
-                    month_end = month_start + relativedelta(months=1) - pd.Timedelta(days=1)
-                    if month_end > end:
-                        month_end = end
-
-                    tqdm.write(f"Processing geometry {idx}, Month {month_start.strftime('%Y-%m')}")
-
-                    s2 = (ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
-                          .filterBounds(fc_geom)
-                          .filterDate(month_start.strftime('%Y-%m-%d'), month_end.strftime('%Y-%m-%d'))
-                          .filter(ee.Filter.lte('CLOUDY_PIXEL_PERCENTAGE', cloud_thresh))
-                          .select(['B1','B2','B3','B4','B5','B6','B7','B8','B8A','B11','B12','B9'])
-                          )
-
-                    if s2.size().getInfo() == 0:
-                        tqdm.write(f"  → No images found for geometry {idx}, Month {month_start.strftime('%Y-%m')}")
-                        current += relativedelta(months=1)
-                        continue
-
-                    s2_median = s2.median()
-                    band_names = s2_median.bandNames().getInfo()
-                    s2_normalized = ee.Image.cat([s2_median.select(b).unitScale(0, 3000) for b in band_names])
-
-                    sample = s2_normalized.sampleRegions(collection=fc_geom, properties=list(properties.keys()), scale=10)
-                    df = geemap.ee_to_df(sample)
-                    df['geometry_idx'] = idx
-                    df['month'] = month_start.strftime('%Y-%m')
-                    all_samples.append(df)
-
-                    current += relativedelta(months=1)
-
-        if all_samples:
-            final_df = pd.concat(all_samples, ignore_index=True)
-            final_df.to_csv(output_file, index=False)
+        if pd.to_datetime(end_date) <= pd.to_datetime(start_date):
+            logger.warning("⚠️ Empty date range. Exiting.")
+            return
+
+        gdf_parts = split_geometries(gdf_points, label_col)
+
+        output_file = Path(output_file).with_suffix('.parquet')
+
+        if export_backend == "gcs":
+            # Unique per run so concurrent or consecutive exports do not overwrite each other;
+            # task descriptions only allow letters, digits and . , : ; _ -
+            run_name = f"{output_file.stem}_{time.strftime('%Y%m%d-%H%M%S')}"
+            prefix = re.sub(r'[^A-Za-z0-9.,:;_-]', '_', run_name)[:90]
+            tables = iter_gcs_export_tables(gdf_parts, properties, start_date, end_date, cloud_thresh,
+                                            os.environ["GCS_BUCKET"], prefix, batch_size=batch_size)
+        else:
+            tables = iter_batch_tables(gdf_parts, properties, start_date, end_date, cloud_thresh,
+                                       workers=workers, batch_size=batch_size)
+
+        try:
+            written = write_parquet(tables, output_file)
+        finally:
+            # Stops the pending batches or export tasks if writing failed
+            tables.close()
+
+        if written:
             logger.success(f"✅ Export completed: {output_file}")
         else:
-            logger.warning("⚠️ No data sampled. CSV not created.")
+            logger.warning("⚠️ No data sampled. Parquet file not created.")
 
     except Exception as e:
         logger.error(e)
 
 if __name__ == "__main__":
     load_dotenv()
-    ee.Authenticate()
-    ee.Initialize(project=os.getenv("EE_PROJECT"))
+    init_ee()
 
     parser = argparse.ArgumentParser(description='Download Sentinel-2 monthly composites for GeoJSON Points & Polygons')
     parser.add_argument('--input', type=str, required=True, help='Path to the GeoJSON with points/polygons')
@@ -164,9 +407,19 @@ if __name__ == "__main__":
     parser.add_argument('--end', type=str, required=True, help='End date YYYY-MM-DD')
     parser.add_argument('--landcover', type=str, required=True, help='Name of the column containing land cover types in the input file')
     parser.add_argument('--cloud', type=float, default=30, help='Max cloud percentage')
-    parser.add_argument('--output', type=str, default='all_points_s2.csv', help='Output CSV file')
+    parser.add_argument('--output', type=str, default='all_points_s2.parquet', help='Output Parquet file')
+    region = parser.add_mutually_exclusive_group()
+    region.add_argument('--bbox', type=float, nargs=4, metavar=('MINX', 'MINY', 'MAXX', 'MAXY'),
+                        help='Only read input features intersecting this bounding box')
+    region.add_argument('--roi', type=str, help='Only read input features intersecting the geometries of this file')
+    parser.add_argument('--export-backend', choices=['local', 'gcs'], default='local',
+                        help='local: download samples directly; gcs: export to the GCS_BUCKET bucket first (large outputs)')
+    parser.add_argument('--workers', type=int, default=16, help='Number of geometry batches requested in parallel')
+    parser.add_argument('--batch-size', type=int, default=500, help='Number of geometries per request or export task')
 
     args = parser.parse_args()
     input_path = Path(args.input)
 
-    get_sentinel2_monthly(input_path, args.start, args.end, cloud_thresh=args.cloud, output_file=args.output,label_col=args.landcover )
\ No newline at end of file
+    get_sentinel2_monthly(input_path, args.start, args.end, cloud_thresh=args.cloud, output_file=args.output,label_col=args.landcover,
+                          bbox=args.bbox, roi=args.roi, export_backend=args.export_backend,
+                          workers=args.workers, batch_size=args.batch_size)
\ No newline at end of file
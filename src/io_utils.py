@@ -0,0 +1,103 @@
+"""Shared helpers to read the input vector files (GeoJSON, shapefile)."""
+
+import functools
+import os
+from pathlib import Path
+
+import geopandas as gpd
+from loguru import logger
+from shapely.geometry import box
+
+try:
+    import pyogrio  # noqa: F401
+    READ_ENGINE = "pyogrio"
+except ImportError:
+    READ_ENGINE = "fiona"
+
+
+def _mask_series(mask, mask_crs):
+    """Wrap a mask geometry with its CRS, so it can be reprojected to the file CRS."""
+    if mask is None or mask_crs is None:
+        return mask
+    return gpd.GeoSeries([mask], crs=mask_crs)
+
+
+@functools.lru_cache(maxsize=8)
+def _read_cached(path: str, mtime: float, bbox=None, mask=None, mask_crs=None) -> gpd.GeoDataFrame:
+    """Parse a vector file. `mtime` is part of the cache key so edited files are re-read."""
+    source = Path(path)
+    # Keep the full name so points.shp and points.geojson get distinct caches
+    cache = source.with_name(source.name + '.feather')
+
+    # A Feather copy newer than the source skips the OGR parse entirely
+    if cache.exists() and cache.stat().st_mtime >= mtime:
+        data = gpd.read_feather(cache)
+        if bbox is not None:
+            data = data[data.intersects(box(*bbox))]
+        if mask is not None:
+            if mask_crs is not None and data.crs is not None:
+                mask = _mask_series(mask, mask_crs).to_crs(data.crs).iloc[0]
+            data = data[data.intersects(mask)]
+        # Match the fresh 0..k index of a filtered OGR read, so geometry_idx does not depend on the cache
+        return data.reset_index(drop=True)
+
+    data = gpd.read_file(path, engine=READ_ENGINE, bbox=bbox, mask=_mask_series(mask, mask_crs))
+    # Only full reads are cached, a filtered read would not be reusable
+    if bbox is None and mask is None:
+        # Write to a temporary file first: an interrupted write must not leave a corrupt cache behind
+        tmp = cache.with_name(f"{cache.name}.{os.getpid()}.tmp")
+        try:
+            data.to_feather(tmp)
+            os.replace(tmp, cache)
+        except Exception as e:
+            # The cache is optional, never fail a successful read because of it
+            tmp.unlink(missing_ok=True)
+            logger.warning(f"⚠️ Could not write cache {cache}: {e}")
+    return data
+
+
+def _source_mtime(path: Path):
+    """
+    Newest modification time of a local vector file, including the sidecar files of a shapefile
+    (.dbf, .shx, .prj...), so attribute edits are seen. None for non-local sources (URLs, /vsi*, zip://).
+    """
+    if not path.is_file():
+        return None
+    if path.suffix.lower() == '.shp':
+        return max(p.stat().st_mtime for p in path.parent.iterdir() if p.stem == path.stem)
+    return path.stat().st_mtime
+
+
+def loading_data(path_data: Path, bbox=None, mask=None) -> gpd.GeoDataFrame:
+    """
+    Load a GeoJSON or shapefile into a GeoDataFrame.
+    bbox: (minx, miny, maxx, maxy) tuple in the file CRS.
+    mask: GeoDataFrame/GeoSeries (reprojected to the file CRS) or shapely geometry (in the file CRS).
+    Only the intersecting features are parsed, so pass one of them (not both) for large national-scale files.
+    Full reads of local files are cached as <name>.feather next to the source, reused while it is newer than the source.
+    """
+    if bbox is not None and mask is not None:
+        raise ValueError("⚠️ bbox and mask can not be used together.")
+    if bbox is not None:
+        bbox = tuple(bbox)
+    # Frames are reduced to one hashable geometry plus its CRS for the parse cache key
+    mask_crs = None
+    if isinstance(mask, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        mask_crs = mask.crs.to_string() if mask.crs is not None else None
+        mask = mask.union_all()
+    try:
+        mtime = _source_mtime(Path(path_data))
+        if mtime is None:
+            # Remote or virtual sources are read directly, without caching
+            data = gpd.read_file(path_data, engine=READ_ENGINE, bbox=bbox, mask=_mask_series(mask, mask_crs))
+        else:
+            data = _read_cached(str(Path(path_data).resolve()), mtime, bbox, mask, mask_crs).copy()
+    except Exception as e:
+        raise RuntimeError(f"⚠️ Failed to read {path_data}: {e}")
+    if data.empty:
+        raise ValueError(f"⚠️ The file {path_data} is empty or invalid.")
+    logger.success(f"✅ Loaded {len(data)} records from {path_data}")
+    # to_string gives "EPSG:4326" for both a parsed file and a Feather cache (which stores PROJJSON)
+    crs = data.crs.to_string() if data.crs is not None else None
+    logger.info(f"Columns: {list(data.columns)} | CRS: {crs}")
+    return data
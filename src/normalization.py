@@ -1,10 +1,59 @@
 import  numpy as np
 
-def normalize(array):
-    """Normalize a numpy array to the range 0.0 - 1.0"""
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# Below this size, thread start-up costs more than the numpy passes it saves
+NUMBA_MIN_SIZE = 1 << 16
+
+
+def _normalize_numpy(array):
+    """Normalize with numpy reductions (fallback when numba is unavailable)."""
     array_min, array_max = np.nanmin(array), np.nanmax(array)
 
     if array_max == array_min:
         return np.zeros_like(array)
 
-    return (array - array_min) / (array_max - array_min)
\ No newline at end of file
+    # float32 bands stay float32; subtract into a fresh buffer, then scale it in place
+    dtype = np.float32 if array.dtype == np.float32 else np.float64
+    out = np.subtract(array, array_min, dtype=dtype)
+    np.multiply(out, 1.0 / (array_max - array_min), out=out)
+    return out
+
+
+if njit is not None:
+    # No "nnan" fast-math flag: the v == v test must keep skipping NaNs
+    @njit(parallel=True, fastmath={"reassoc", "contract", "arcp", "nsz"}, cache=True)
+    def _normalize_nb(arr, out):
+        """Fill `out` with `arr` scaled to 0-1. Returns False when `arr` is constant."""
+        array_min = np.inf
+        array_max = -np.inf
+        for i in prange(arr.size):
+            v = arr[i]
+            if v == v:
+                array_min = min(array_min, v)
+                array_max = max(array_max, v)
+
+        if array_max == array_min:
+            return False
+
+        inv = 1.0 / (array_max - array_min)
+        for i in prange(arr.size):
+            out[i] = (arr[i] - array_min) * inv
+        return True
+
+
+def normalize(array):
+    """Normalize a numpy array to the range 0.0 - 1.0"""
+    array = np.asarray(array)
+    if njit is None or array.size < NUMBA_MIN_SIZE:
+        return _normalize_numpy(array)
+
+    array = np.ascontiguousarray(array)
+    dtype = np.float32 if array.dtype == np.float32 else np.float64
+    out = np.empty(array.shape, dtype=dtype)
+    if not _normalize_nb(array.ravel(), out.ravel()):
+        return np.zeros_like(array)
+    return out